@@ -152,6 +152,9 @@ class StableMultiDiffusionPipeline(nn.Module):
             self.pipe.scheduler = LCMScheduler.from_config(self.pipe.scheduler.config)
             self.scheduler = self.pipe.scheduler
             self.pipe.load_lora_weights(lora_key, weight_name=lora_weight_name, adapter_name='lcm')
+            # Merge the LCM LoRA into the base weights and drop the LoRA layers.
+            self.pipe.fuse_lora()
+            self.pipe.unload_lora_weights()
             self.default_num_inference_steps = 4
             self.default_guidance_scale = 1.0
 
@@ -41,7 +41,7 @@ from diffusers.utils import (
     logging,
 )
 from huggingface_hub import hf_hub_download
-from safetensors.torch import load_file
+from safetensors.torch import load_file, save_file
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
@@ -51,7 +51,10 @@ import torch.nn.functional as F
 import torchvision.transforms as T
 from einops import rearrange
 
-from typing import Tuple, List, Literal, Optional, Union
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Dict, Tuple, List, Literal, Optional, Union
 from tqdm import tqdm
 from PIL import Image
 
@@ -73,11 +76,141 @@ def rescale_noise_cfg(noise_cfg, noise_pred_text, guidance_rescale=0.0):
     return noise_cfg
 
 
+def channels_last_copy(x: torch.Tensor) -> torch.Tensor:
+    r"""Return a channels-last tensor with the same values as `x` that does
+    not share memory with it, so that it can be modified in-place. The
+    layout conversion is the only copy made.
+    """
+    y = x.contiguous(memory_format=torch.channels_last)
+    return y.clone(memory_format=torch.channels_last) if y is x else y
+
+
+def mask_cache_key(x):
+    r"""Make a hashable key of a mask-related argument of `process_mask`.
+    Images are hashed by their content; tensors by their identity and
+    version counter, so that in-place modifications invalidate the key.
+    Inference tensors do not have a version counter and are never cached;
+    see `has_inference_tensor`.
+    """
+    if isinstance(x, Image.Image):
+        return (x.mode, x.size, hashlib.sha1(x.tobytes()).hexdigest())
+    if isinstance(x, torch.Tensor):
+        return (id(x), x._version)
+    if isinstance(x, (list, tuple)):
+        return tuple(mask_cache_key(v) for v in x)
+    return x
+
+
+def has_inference_tensor(x) -> bool:
+    r"""Check if a mask-related argument of `process_mask` contains a tensor
+    created under `torch.inference_mode`, whose in-place modifications
+    cannot be detected.
+    """
+    if isinstance(x, torch.Tensor):
+        return x.is_inference()
+    if isinstance(x, (list, tuple)):
+        return any(has_inference_tensor(v) for v in x)
+    return False
+
+
+def quantize_mask(
+    masks: torch.Tensor,
+    noise_lvs: torch.Tensor,
+    next_noise_lvs: torch.Tensor,
+    mask_type: Literal['discrete', 'semi-continuous', 'continuous'] = 'discrete',
+) -> torch.Tensor:
+    r"""Quantize the strength-multiplied masks into the noise levels of the
+    scheduler. See `StableMultiDiffusionSDXLPipeline.process_mask`.
+
+    Args:
+        masks (torch.Tensor): Masks of shape (P, 1, 1, H, W).
+        noise_lvs (torch.Tensor): Noise levels of shape (1, T, 1, 1, 1).
+        next_noise_lvs (torch.Tensor): Noise levels of the next steps of shape
+            (1, T, 1, 1, 1).
+        mask_type (str): One of 'discrete', 'semi-continuous', and
+            'continuous'.
+
+    Returns: A quantized mask of shape (P, T, 1, H, W).
+    """
+    if mask_type == 'discrete':
+        # Discrete mode. Each pixel is bucketized once against the sorted noise levels, and the binary
+        # mask of each step is the comparison of the bucket index with the rank of its noise level.
+        lvs_sorted, order = noise_lvs.view(-1).to(masks.dtype).sort()
+        rank = torch.empty_like(order)
+        rank[order] = torch.arange(len(order), device=order.device)
+        masks = torch.bucketize(masks, lvs_sorted, out_int32=True) > rank.view(1, -1, 1, 1, 1)
+    elif mask_type == 'semi-continuous':
+        # Semi-continuous mode (continuous at the last step only).
+        is_last = torch.arange(noise_lvs.shape[1], device=masks.device).view(1, -1, 1, 1, 1) == noise_lvs.shape[1] - 1
+        masks = torch.where(
+            is_last,
+            ((masks - next_noise_lvs) / (noise_lvs - next_noise_lvs)).clamp(0, 1),
+            (masks > noise_lvs).to(masks.dtype),
+        )
+    elif mask_type == 'continuous':
+        # Continuous mode: Have the exact same `1` coverage with discrete mode, but the mask gradually
+        #                  decreases continuously after the discrete mode boundary to become `0` at the
+        #                  next lower threshold.
+        masks = ((masks - next_noise_lvs) / (noise_lvs - next_noise_lvs)).clamp(0, 1)
+    return masks
+
+
+def bootstrap_mix(
+    latents_: torch.Tensor,
+    bg_latents_: torch.Tensor,
+    white_: torch.Tensor,
+    fg_mask_: torch.Tensor,
+    mix_ratio: float,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    r"""Fill the outside of the foreground masks of a view with the boot-
+    strapping background, which is the background latent mixed with the
+    noisy white latent by `mix_ratio`.
+
+    Args:
+        latents_ (torch.Tensor): Latents of the view of shape (P, C, h, w).
+        bg_latents_ (torch.Tensor): Background latent of shape (1, C, h, w).
+        white_ (torch.Tensor): Noisy white latent of shape (1, C, h, w).
+        fg_mask_ (torch.Tensor): Foreground masks of shape (P, 1, h, w).
+        mix_ratio (float): Ratio of the white latent in the background.
+
+    Returns: A tuple of the bootstrapped latents and the bootstrapping
+        background.
+    """
+    bg_latents_ = torch.lerp(bg_latents_, white_, mix_ratio)
+    latents_ = torch.lerp(bg_latents_, latents_, fg_mask_)
+    return latents_, bg_latents_
+
+
+def mix_tile(
+    latents_: torch.Tensor,
+    fg_mask_: torch.Tensor,
+    tile_mask_: torch.Tensor,
+    value_: torch.Tensor,
+    count_: torch.Tensor,
+) -> None:
+    r"""Accumulate the masked latents of a single view into the (sliced)
+    panorama buffers in-place.
+
+    Args:
+        latents_ (torch.Tensor): Denoised latents of the view of shape
+            (P, C, h, w).
+        fg_mask_ (torch.Tensor): Foreground masks of the view of shape
+            (P, 1, h, w).
+        tile_mask_ (torch.Tensor): Tile blending mask of shape (1, 1, h, w).
+        value_ (torch.Tensor): Slice of the weighted latent sum of shape
+            (1, C, h, w).
+        count_ (torch.Tensor): Slice of the weight sum of shape (1, C, h, w).
+    """
+    fg_mask_ = fg_mask_ * tile_mask_
+    value_ += (fg_mask_ * latents_).sum(dim=0, keepdim=True)
+    count_ += fg_mask_.sum(dim=0, keepdim=True)
+
+
 class StableMultiDiffusionSDXLPipeline(nn.Module):
     def __init__(
         self,
         device: torch.device,
-        dtype: torch.dtype = torch.float16,
+        dtype: Optional[torch.dtype] = None,
         hf_key: Optional[str] = None,
         lora_key: Optional[str] = None,
         load_from_local: bool = False, # Turn on if you have already downloaed LoRA & Hugging Face hub is down.
@@ -92,6 +225,13 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
         mask_type: Literal['discrete', 'semi-continuous', 'continuous'] = 'discrete',
         has_i2t: bool = True,
         lora_weight: float = 1.0,
+        compile_model: bool = False,
+        quantize: Literal['none', 'fp8', 'int8'] = 'none',
+        cache_dir: Optional[str] = None,
+        use_cuda_graph: bool = False,
+        prompt_cache_size: int = 8,
+        mask_cache_size: int = 8,
+        verbose: bool = False,
     ) -> None:
         r"""Stabilized MultiDiffusion for fast sampling.
 
@@ -100,6 +240,10 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
 
         Args:
             device (torch.device): Specify CUDA device.
+            dtype (Optional[torch.dtype]): Precision of the models and the
+                latents. The denoising loop runs without autocast, so every
+                tensor in the loop is kept in this dtype. If None, bf16 is used
+                on CUDA devices that support it, and fp16 otherwise.
             hf_key (Optional[str]): Custom StableDiffusion checkpoint for
                 stylized generation.
             lora_key (Optional[str]): Custom Lightning LoRA for acceleration.
@@ -140,13 +284,39 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
                 the mask standard deviation.
             has_i2t (bool): Automatic background image to text prompt con-
                 version with BLIP-2 model. May not be necessary for the non-
-                streaming application.
+                streaming application. The model is loaded on the first use
+                and kept in the CPU memory while idle.
             lora_weight (float): Adjusts weight of the LCM/Lightning LoRA.
                 Heavily affects the overall quality!
+            compile_model (bool): Compile the U-Net and the VAE decoder with
+                `torch.compile` in `reduce-overhead` mode. The first call at
+                each resolution is slow due to graph capture, but subsequent
+                calls replay the captured CUDA graphs.
+            quantize (Literal['none', 'fp8', 'int8']): Weight-only quantiza-
+                tion of the U-Net linear layers with `torchao`. FP8 requires
+                Ada or Hopper GPUs. The VAE is kept in the original precision.
+                Needs the optional dependency `torchao>=0.5` with `torch>=2.3`,
+                which is newer than the torch pinned in `requirements.txt`.
+            cache_dir (Optional[str]): Directory to store the encoded white
+                background latent and the LoRA-merged U-Net weights so that
+                the VAE encoding and the LoRA merging are skipped on the next
+                initialization. Disabled if None.
+            use_cuda_graph (bool): Capture the U-Net forward into a CUDA graph
+                for each input shape and replay it at every denoising step to
+                remove the kernel launch overhead. Ignored if `compile_model`
+                is set, since the `reduce-overhead` mode already does this.
+            prompt_cache_size (int): Maximum number of prompt sets whose text
+                embeddings are kept for reuse in the subsequent calls.
+            mask_cache_size (int): Maximum number of preprocessed mask sets
+                kept for reuse in the subsequent calls.
+            verbose (bool): Show a progress bar over the denoising steps.
         """
         super().__init__()
 
         self.device = device
+        if dtype is None:
+            use_bf16 = torch.device(device).type == 'cuda' and torch.cuda.is_bf16_supported()
+            dtype = torch.bfloat16 if use_bf16 else torch.float16
         self.dtype = dtype
 
         self.default_mask_std = default_mask_std
@@ -158,6 +328,17 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
         self.default_bootstrap_leak_sensitivity = default_bootstrap_leak_sensitivity
         self.default_preprocess_mask_cover_alpha = default_preprocess_mask_cover_alpha
         self.mask_type = mask_type
+        self.cache_dir = cache_dir
+        self.compile_model = compile_model
+        self.use_cuda_graph = use_cuda_graph and not compile_model
+        self.cuda_graphs = {}
+        self.prompt_cache = OrderedDict()
+        self.prompt_cache_size = prompt_cache_size
+        self.mask_cache = OrderedDict()
+        self.mask_cache_size = mask_cache_size
+        self.verbose = verbose
+        self.value_buffer = None
+        self.count_buffer = None
 
         # Create model.
         print(f'[INFO] Loading Stable Diffusion...')
@@ -171,9 +352,26 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
             lora_ckpt = 'sdxl_lightning_4step_lora.safetensors'
 
             self.pipe = load_model(model_key, 'xl', self.device, self.dtype)
-            self.pipe.load_lora_weights(hf_hub_download(lightning_repo, lora_ckpt), adapter_name='lightning')
-            self.pipe.set_adapters(["lightning"], adapter_weights=[lora_weight])
-            self.pipe.fuse_lora()
+            merged_path = None
+            if cache_dir is not None:
+                model_name = model_key.replace('/', '--')
+                lora_name = os.path.splitext(lora_ckpt)[0]
+                dtype_name = str(self.dtype).split('.')[-1]
+                merged_path = os.path.join(
+                    cache_dir, f'unet_{model_name}_{lora_name}_{lora_weight}_{dtype_name}.safetensors')
+
+            if merged_path is not None and os.path.exists(merged_path):
+                print(f'[INFO] Loading LoRA-merged U-Net from {merged_path}')
+                self.pipe.unet.load_state_dict(load_file(merged_path, device=str(self.device)))
+            else:
+                self.pipe.load_lora_weights(hf_hub_download(lightning_repo, lora_ckpt), adapter_name='lightning')
+                self.pipe.set_adapters(["lightning"], adapter_weights=[lora_weight])
+                self.pipe.fuse_lora()
+                # Drop the LoRA layers after fusing so that each linear layer runs as a single GEMM.
+                self.pipe.unload_lora_weights()
+                if merged_path is not None:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    save_file(self.pipe.unet.state_dict(), merged_path)
         else:
             model_key = 'stabilityai/stable-diffusion-xl-base-1.0'
             variant = 'fp16'
@@ -182,11 +380,10 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
             unet = UNet2DConditionModel.from_config(model_key, subfolder='unet').to(self.device, self.dtype)
             unet.load_state_dict(load_file(hf_hub_download(lightning_repo, model_ckpt), device=self.device))
             self.pipe = StableDiffusionXLPipeline.from_pretrained(model_key, unet=unet, torch_dtype=self.dtype, variant=variant).to(self.device)
+        self.model_key = model_key
 
-        # Create model
-        if has_i2t:
-            self.i2t_processor = Blip2Processor.from_pretrained('Salesforce/blip2-opt-2.7b')
-            self.i2t_model = Blip2ForConditionalGeneration.from_pretrained('Salesforce/blip2-opt-2.7b')
+        # BLIP-2 is loaded lazily at the first call of `get_text_prompts`.
+        self.has_i2t = has_i2t
 
         # Use SDXL-Lightning LoRA by default.
         self.pipe.scheduler = EulerDiscreteScheduler.from_config(
@@ -211,6 +408,56 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
         self.unet = self.pipe.unet
         self.vae_scale_factor = self.pipe.vae_scale_factor
 
+        # Large (panorama) images are encoded and decoded by overlapping tiles to bound the peak memory.
+        self.vae.enable_slicing()
+        self.vae.enable_tiling()
+
+        # Force the fused SDPA kernel (FlashAttention backend when available) and fuse the
+        # QKV projections into a single GEMM per attention block.
+        self.unet.set_attn_processor(AttnProcessor2_0())
+        self.unet.fuse_qkv_projections()
+
+        # NHWC layout lets cuDNN pick the tensor core implicit GEMM kernels for convolutions.
+        torch.backends.cudnn.benchmark = True
+        self.unet.to(memory_format=torch.channels_last)
+        self.vae.to(memory_format=torch.channels_last)
+
+        if quantize not in ('none', 'fp8', 'int8'):
+            raise ValueError(f'Quantization mode {quantize} not supported.')
+        if quantize != 'none':
+            try:
+                from torchao.quantization import quantize_, float8_weight_only, int8_weight_only
+            except ImportError as e:
+                raise ImportError(
+                    f'`quantize={quantize!r}` requires the optional dependency `torchao>=0.5`, which in turn '
+                    f'requires `torch>=2.3` (found torch {torch.__version__}). Install it with '
+                    '`pip install torchao`, or use `quantize=\'none\'`.'
+                ) from e
+            if quantize == 'fp8':
+                quantize_(self.unet, float8_weight_only())
+            else:
+                quantize_(self.unet, int8_weight_only())
+
+        if compile_model:
+            # Compile after the LoRA is fused so that the graph sees the final weights.
+            torch._inductor.config.conv_1x1_as_mm = True
+            torch._inductor.config.coordinate_descent_tuning = True
+            torch._inductor.config.epilogue_fusion = False
+            self.unet = torch.compile(self.unet, mode='reduce-overhead', fullgraph=True, dynamic=False)
+            self.vae.decode = torch.compile(self.vae.decode, mode='reduce-overhead')
+            # Fuses the compare/arithmetic/select of mask quantization into a single kernel. CUDA graphs
+            # are not used here since the quantized masks outlive the call.
+            self.quantize_mask = torch.compile(quantize_mask, dynamic=True)
+            # Fuses the masking, the reduction over prompts, and the accumulation of each view. The cache
+            # limit is raised to hold the graphs of the different view shapes of tiled and non-tiled runs.
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+            self.mix_tile = torch.compile(mix_tile)
+            self.bootstrap_mix = torch.compile(bootstrap_mix)
+        else:
+            self.quantize_mask = quantize_mask
+            self.mix_tile = mix_tile
+            self.bootstrap_mix = bootstrap_mix
+
         # Prepare white background for bootstrapping.
         self.get_white_background(1024, 1024)
 
@@ -262,20 +509,30 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
         if num_inference_steps is None:
             num_inference_steps = self.default_num_inference_steps
 
-        self.scheduler.set_timesteps(num_inference_steps)
-        self.timesteps = self.scheduler.timesteps[torch.tensor(t_index_list)]
+        # Mask quantization depends on the schedule only through these.
+        self.schedule_key = (tuple(t_index_list), num_inference_steps)
+
+        # Scheduler tensors are moved to the device once, and indexed there.
+        self.scheduler.set_timesteps(num_inference_steps, device=self.device)
+        idx = torch.as_tensor(t_index_list, dtype=torch.long, device=self.device)
+        self.timesteps = self.scheduler.timesteps.to(self.device)[idx]
 
         # EulerDiscreteScheduler
 
-        self.sigmas = self.scheduler.sigmas[torch.tensor(t_index_list)]
+        self.sigmas = self.scheduler.sigmas.to(self.device)[idx]
         self.sigmas_next = torch.cat([self.sigmas, self.sigmas.new_zeros(1)])[1:]
         sigma_mask = torch.logical_and(s_tmin <= self.sigmas, self.sigmas <= s_tmax)
         # self.gammas = min(s_churn / (len(self.sigmas) - 1), 2**0.5 - 1) * sigma_mask
         self.gammas = min(s_churn / (num_inference_steps - 1), 2**0.5 - 1) * sigma_mask
         self.sigma_hats = self.sigmas * (self.gammas + 1)
-        self.dt = self.sigmas_next - self.sigma_hats
+        self.dt = (self.sigmas_next - self.sigma_hats).to(torch.float32)
+
+        # Post-step noise levels. The branch condition is resolved here once, instead of
+        # synchronizing with the device at every `scheduler_add_noise` call.
+        self.post_noise_lvs = (self.sigma_hats**2 - self.sigmas**2) ** 0.5
+        self.has_post_noise = torch.logical_and(self.gammas > 0, self.post_noise_lvs > 0).tolist()
 
-        noise_lvs = self.sigmas * (self.sigmas**2 + 1)**(-0.5)
+        noise_lvs = self.sigmas * (self.sigmas**2 + 1).rsqrt()
         self.noise_lvs = noise_lvs[None, :, None, None, None]
         self.next_noise_lvs = torch.cat([noise_lvs[1:], noise_lvs.new_zeros(1)])[None, :, None, None, None]
 
@@ -551,12 +808,14 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
 
         return prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def get_text_prompts(self, image: Image.Image) -> str:
         r"""A convenient method to extract text prompt from an image.
 
         This is called if the user does not provide background prompt but only
         the background image. We use BLIP-2 to automatically generate prompts.
+        The BLIP-2 model is loaded at the first call, and it only occupies the
+        GPU memory during the generation.
 
         Args:
             image (Image.Image): A PIL image.
@@ -564,16 +823,26 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
         Returns:
             A single string of text prompt.
         """
-        if hasattr(self, 'i2t_model'):
-            question = 'Question: What are in the image? Answer:'
-            inputs = self.i2t_processor(image, question, return_tensors='pt')
-            out = self.i2t_model.generate(**inputs, max_new_tokens=77)
-            prompt = self.i2t_processor.decode(out[0], skip_special_tokens=True).strip()
-            return prompt
-        else:
+        if not self.has_i2t:
             return ''
 
-    @torch.no_grad()
+        if not hasattr(self, 'i2t_model'):
+            self.i2t_processor = Blip2Processor.from_pretrained('Salesforce/blip2-opt-2.7b')
+            self.i2t_model = Blip2ForConditionalGeneration.from_pretrained(
+                'Salesforce/blip2-opt-2.7b', torch_dtype=self.dtype)
+
+        question = 'Question: What are in the image? Answer:'
+        inputs = self.i2t_processor(image, question, return_tensors='pt').to(self.device, self.dtype)
+        self.i2t_model.to(self.device)
+        try:
+            out = self.i2t_model.generate(**inputs, max_new_tokens=77)
+        finally:
+            self.i2t_model.to('cpu')
+            torch.cuda.empty_cache()
+        prompt = self.i2t_processor.decode(out[0], skip_special_tokens=True).strip()
+        return prompt
+
+    @torch.inference_mode()
     def encode_imgs(
         self,
         imgs: torch.Tensor,
@@ -608,11 +877,11 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
                 raise AttributeError('Could not access latents of provided encoder_output')
 
         vae = self.vae if vae is None else vae
-        imgs = 2 * imgs - 1
+        imgs = channels_last_copy(imgs).mul_(2).sub_(1)
         latents = vae.config.scaling_factor * _retrieve_latents(vae.encode(imgs), generator=generator)
         return latents
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def decode_latents(self, latents: torch.Tensor, vae: Optional[nn.Module] = None) -> torch.Tensor:
         r"""A wrapper function for VAE decoder of the latent diffusion model.
 
@@ -627,19 +896,20 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
             encoder. Shape: (B, 3, H, W).
         """
         vae = self.vae if vae is None else vae
-        latents = 1 / vae.config.scaling_factor * latents
+        latents = channels_last_copy(latents).mul_(1 / vae.config.scaling_factor)
         imgs = vae.decode(latents).sample
-        imgs = (imgs / 2 + 0.5).clip_(0, 1)
+        imgs = imgs.mul_(0.5).add_(0.5).clip_(0, 1)
         return imgs
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def get_white_background(self, height: int, width: int) -> torch.Tensor:
         r"""White background image latent for bootstrapping or in case of
         absent background.
 
         Additionally stores the maximally-sized white latent for fast retrieval
         in the future. By default, we initially call this with 1024x1024 sized
-        white image, so the function is rarely visited twice.
+        white image, so the function is rarely visited twice. If `cache_dir`
+        is given, the latent is also saved to and loaded from the disk.
 
         Args:
             height (int): The height of the white *image*, not its latent.
@@ -651,12 +921,24 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
             size is smaller than what we already have created.
         """
         if not hasattr(self, 'white') or self.white.shape[-2] < height or self.white.shape[-1] < width:
-            white = torch.ones(1, 3, height, width, dtype=self.dtype, device=self.device)
-            self.white = self.encode_imgs(white)
+            cache_path = None
+            if self.cache_dir is not None:
+                model_name = self.model_key.replace('/', '--')
+                dtype_name = str(self.dtype).split('.')[-1]
+                cache_path = os.path.join(self.cache_dir, f'white_{model_name}_{dtype_name}_{height}x{width}.pt')
+
+            if cache_path is not None and os.path.exists(cache_path):
+                self.white = torch.load(cache_path, map_location=self.device)
+            else:
+                white = torch.ones(1, 3, height, width, dtype=self.dtype, device=self.device)
+                self.white = self.encode_imgs(white)
+                if cache_path is not None:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    torch.save(self.white.cpu(), cache_path)
             return self.white
         return self.white[..., :(height // self.vae_scale_factor), :(width // self.vae_scale_factor)]
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def process_mask(
         self,
         masks: Union[torch.Tensor, Image.Image, List[Image.Image]],
@@ -724,7 +1006,9 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
                 the maximal pixel value (that is, 127.5) is considered as the
                 designated mask.
             timesteps (Optional[torch.Tensor]): Defines the scheduler noise
-                levels that acts as bins of mask quantization.
+                levels that acts as bins of mask quantization. Kept for
+                interface compatibility; the noise levels of the schedule set
+                by `prepare_lightning_schedule` are always used.
             preprocess_mask_cover_alpha (Optional[float]): Optional pre-
                 processing where each mask covered by other masks is reduced in
                 its alpha value by this specified factor. Overrides the default
@@ -739,7 +1023,33 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
                 generation.
           - std: Mask blur standard deviation. Used for optionally specified
                 foreground-background blending after image generation.
+          The results are cached for the subsequent calls with the same
+          arguments, and fresh copies are returned every time. Arguments
+          containing inference tensors are not cached, since their in-place
+          modifications cannot be detected.
         """
+        # Preprocessed masks are reused if the same masks are processed again with the same settings.
+        # The arguments are kept in the entry so that the identities of the tensors in the key stay valid.
+        if preprocess_mask_cover_alpha is None:
+            preprocess_mask_cover_alpha = self.default_preprocess_mask_cover_alpha
+        cache_key = None
+        if self.mask_cache_size > 0 and not has_inference_tensor((masks, strength, std)):
+            cache_key = (
+                mask_cache_key(masks),
+                mask_cache_key(self.default_mask_strength if strength is None else strength),
+                mask_cache_key(self.default_mask_std if std is None else std),
+                height,
+                width,
+                use_boolean_mask,
+                preprocess_mask_cover_alpha,
+                self.mask_type,
+                self.schedule_key,
+            )
+            if cache_key in self.mask_cache:
+                self.mask_cache.move_to_end(cache_key)
+                return tuple(x.clone() for x in self.mask_cache[cache_key][1])
+        cache_args = (masks, strength, std)
+
         if isinstance(masks, Image.Image):
             masks = [masks]
         if isinstance(masks, (tuple, list)):
@@ -749,32 +1059,25 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
                 proc = lambda m: T.ToTensor()(m)[None, -1:] < 0.5
             else:
                 proc = lambda m: 1.0 - T.ToTensor()(m)[None, -1:]
-            masks = torch.cat([proc(mask) for mask in masks], dim=0).float().clip_(0, 1)
-        masks = F.interpolate(masks.float(), size=(height, width), mode='bilinear', align_corners=False)
-        masks = masks.to(self.device)
+            masks = torch.cat([proc(mask) for mask in masks], dim=0)
+        if masks.device.type == 'cpu' and torch.device(self.device).type == 'cuda':
+            masks = masks.pin_memory()
+        # Copied in the source dtype so that the pinned buffer is used directly (a dtype-changing copy is
+        # converted on the host first); the conversion and resizing are done on the device.
+        masks = masks.to(self.device, non_blocking=True).float()
+        if masks.shape[-2:] != (height, width):
+            masks = F.interpolate(masks, size=(height, width), mode='bilinear', align_corners=False)
 
         # Background mask alpha is decayed by the specified factor where foreground masks covers it.
-        if preprocess_mask_cover_alpha is None:
-            preprocess_mask_cover_alpha = self.default_preprocess_mask_cover_alpha
         if preprocess_mask_cover_alpha > 0:
-            masks = torch.stack([
-                torch.where(
-                    masks[i + 1:].sum(dim=0) > 0,
-                    mask * preprocess_mask_cover_alpha,
-                    mask,
-                ) if i < len(masks) - 1 else mask
-                for i, mask in enumerate(masks)
-            ], dim=0)
-
-        # Scheduler noise levels for mask quantization.
-        if timesteps is None:
-            noise_lvs = self.noise_lvs
-            next_noise_lvs = self.next_noise_lvs
-        else:
-            noise_lvs_ = self.sigmas * (self.sigmas**2 + 1)**(-0.5)
-            # noise_lvs_ = (1 - self.scheduler.alphas_cumprod[timesteps].to(self.device)) ** 0.5
-            noise_lvs = noise_lvs_[None, :, None, None, None].to(masks.device)
-            next_noise_lvs = torch.cat([noise_lvs_[1:], noise_lvs_.new_zeros(1)])[None, :, None, None, None]
+            # Sum of the masks with higher indices, i.e., `masks[i + 1:].sum(dim=0)` for each i.
+            covered = torch.cat((masks.flip(0).cumsum(dim=0).flip(0)[1:], torch.zeros_like(masks[:1])), dim=0)
+            masks = torch.where(covered > 0, masks * preprocess_mask_cover_alpha, masks)
+
+        # Scheduler noise levels for mask quantization. These are derived from the current sigmas, which
+        # already match `self.timesteps`, so we reuse the ones precomputed in `prepare_lightning_schedule`.
+        noise_lvs = self.noise_lvs
+        next_noise_lvs = self.next_noise_lvs
 
         # Mask preprocessing parameters are fetched from the default settings.
         if std is None:
@@ -799,25 +1102,10 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
         # NOTE: This `strength` aligns with `denoising strength`. However, with LCM, using strength < 0.96
         #       gives unpleasant results.
         masks = masks * strength[:, None, None, None]
-        masks = masks.unsqueeze(1).repeat(1, noise_lvs.shape[1], 1, 1, 1)
+        masks = masks.unsqueeze(1)
 
         # Mask is quantized according to the current noise levels specified by the scheduler.
-        if self.mask_type == 'discrete':
-            # Discrete mode.
-            masks = masks > noise_lvs
-        elif self.mask_type == 'semi-continuous':
-            # Semi-continuous mode (continuous at the last step only).
-            masks = torch.cat((
-                masks[:, :-1] > noise_lvs[:, :-1],
-                (
-                    (masks[:, -1:] - next_noise_lvs[:, -1:]) / (noise_lvs[:, -1:] - next_noise_lvs[:, -1:])
-                ).clip_(0, 1),
-            ), dim=1)
-        elif self.mask_type == 'continuous':
-            # Continuous mode: Have the exact same `1` coverage with discrete mode, but the mask gradually
-            #                  decreases continuously after the discrete mode boundary to become `0` at the
-            #                  next lower threshold.
-            masks = ((masks - next_noise_lvs) / (noise_lvs - next_noise_lvs)).clip_(0, 1)
+        masks = self.quantize_mask(masks, noise_lvs, next_noise_lvs, self.mask_type)
 
         # NOTE: Post processing mask strength does not align with conventional 'denoising_strength'. However,
         #       fine-grained mask alpha channel tuning is available with this form.
@@ -825,11 +1113,95 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
 
         h = height // self.vae_scale_factor
         w = width // self.vae_scale_factor
-        masks = rearrange(masks.float(), 'p t () h w -> (p t) () h w')
-        masks = F.interpolate(masks, size=(h, w), mode='nearest')
-        masks = rearrange(masks.to(self.dtype), '(p t) () h w -> p t () h w', p=len(std))
+        stride = self.vae_scale_factor
+        if h * stride == height and w * stride == width:
+            # Nearest neighbor downsampling by an integer factor is a strided slice.
+            masks = masks[..., ::stride, ::stride].to(self.dtype).contiguous()
+        else:
+            masks = rearrange(masks.float(), 'p t () h w -> (p t) () h w')
+            masks = F.interpolate(masks, size=(h, w), mode='nearest')
+            masks = rearrange(masks.to(self.dtype), '(p t) () h w -> p t () h w', p=len(std))
+
+        if cache_key is not None:
+            # The callers get copies, so that their in-place edits do not corrupt the cache.
+            self.mask_cache[cache_key] = (cache_args, (masks, masks_blurred, std))
+            if len(self.mask_cache) > self.mask_cache_size:
+                self.mask_cache.popitem(last=False)
+            return masks.clone(), masks_blurred.clone(), std.clone()
         return masks, masks_blurred, std
 
+    @torch.inference_mode()
+    def unet_forward(
+        self,
+        latent_model_input: torch.Tensor,
+        t: torch.Tensor,
+        prompt_embeds: torch.Tensor,
+        added_cond_kwargs: Dict[str, torch.Tensor],
+    ) -> torch.Tensor:
+        r"""A wrapper function for the noise prediction of the U-Net.
+
+        If `use_cuda_graph` is turned on, the U-Net forward is captured into
+        a CUDA graph once for each set of input shapes, and then replayed with
+        the new inputs copied into the static input buffers. In this case, and
+        if the U-Net is compiled in `reduce-overhead` mode, the output is
+        cloned out of the graph-owned buffer before it is returned.
+
+        Args:
+            latent_model_input (torch.Tensor): Scaled noisy latents.
+            t (torch.Tensor): The current timestep.
+            prompt_embeds (torch.Tensor): Text embeddings for cross-attention.
+            added_cond_kwargs (Dict[str, torch.Tensor]): Additional SDXL
+                conditions, i.e., `text_embeds` and `time_ids`.
+
+        Returns:
+            Predicted noise with the same size as `latent_model_input`.
+        """
+        def _forward(x, t, prompt_embeds, text_embeds, time_ids):
+            return self.unet(
+                x,
+                t,
+                encoder_hidden_states=prompt_embeds,
+                timestep_cond=None,
+                cross_attention_kwargs=None,
+                added_cond_kwargs={'text_embeds': text_embeds, 'time_ids': time_ids},
+                return_dict=False,
+            )[0]
+
+        inputs = (
+            latent_model_input,
+            torch.as_tensor(t, device=self.device),
+            prompt_embeds,
+            added_cond_kwargs['text_embeds'],
+            added_cond_kwargs['time_ids'],
+        )
+        if not self.use_cuda_graph:
+            noise_pred = _forward(*inputs)
+            # The outputs of the U-Net compiled in `reduce-overhead` mode live in CUDA graph buffers that
+            # are overwritten by the next call, while the predictions may be kept over several calls.
+            return noise_pred.clone() if self.compile_model else noise_pred
+
+        key = tuple((x.shape, x.dtype) for x in inputs)
+        if key not in self.cuda_graphs:
+            static_inputs = tuple(x.clone() for x in inputs)
+            # Warm up in a side stream before the capture.
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(2):
+                    _forward(*static_inputs)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_output = _forward(*static_inputs)
+            self.cuda_graphs[key] = (graph, static_inputs, static_output)
+
+        graph, static_inputs, static_output = self.cuda_graphs[key]
+        for static_x, x in zip(static_inputs, inputs):
+            static_x.copy_(x)
+        graph.replay()
+        return static_output.clone()
+
     def scheduler_scale_model_input(
         self,
         latent: torch.FloatTensor,
@@ -873,17 +1245,16 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
         Returns:
             A denoised tensor with the same size as latent.
         """
-        # Upcast to avoid precision issues when computing prev_sample.
-        latent = latent.to(torch.float32)
-
         # 1. Compute predicted original sample (x_0) from sigma-scaled predicted noise.
         assert self.scheduler.config.prediction_type == 'epsilon', 'Only supports `prediction_type` of `epsilon` for now.'
         # pred_original_sample = latent - self.sigma_hats[idx] * noise_pred
         # prev_sample = pred_original_sample + noise_pred * (self.dt[i] + self.sigma_hats[i])
         # return pred_original_sample.to(self.dtype)
 
-        # 2. Convert to an ODE derivative.
-        prev_sample = latent + noise_pred * self.dt[idx]
+        # 2. Convert to an ODE derivative. The step is kept in the half-precision storage dtype; elementwise
+        #    kernels accumulate half operands in fp32 internally, and the step size stays an fp32 scalar, so
+        #    an explicit upcast of the whole latent is not needed to avoid precision issues.
+        prev_sample = torch.addcmul(latent, noise_pred.to(latent.dtype), self.dt[idx])
         return prev_sample.to(self.dtype)
 
     def scheduler_add_noise(
@@ -917,15 +1288,14 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
                 return latent
         else:
             # 3. Post-add noise.
-            noise_lv = (self.sigma_hats[idx]**2 - self.sigmas[idx]**2) ** 0.5
-            if self.gammas[idx] > 0 and noise_lv > 0 and s_noise > 0 and idx < len(self.sigmas) and idx >= 0:
+            if idx < len(self.sigmas) and idx >= 0 and self.has_post_noise[idx] and s_noise > 0:
                 noise = torch.randn_like(latent) if noise is None else noise
-                eps = noise * s_noise * noise_lv
+                eps = noise * s_noise * self.post_noise_lvs[idx]
                 latent = latent + eps
                 # pred_original_sample = pred_original_sample + eps
             return latent
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def __call__(
         self,
         prompts: Optional[Union[str, List[str]]] = None,
@@ -949,6 +1319,9 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
         boostrap_mix_steps: Optional[float] = None,
         bootstrap_leak_sensitivity: Optional[float] = None,
         preprocess_mask_cover_alpha: Optional[float] = None,
+        cfg_cache_interval: int = 1,
+        cfg_cache_warmup: int = 2,
+        tea_cache_threshold: float = 0.0,
     ) -> Image.Image:
         r"""Arbitrary-size image generation from multiple pairs of (regional)
         text prompt-mask pairs.
@@ -1038,6 +1411,18 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
             preprocess_mask_cover_alpha (float): Overrides the default value.
                 Optional preprocessing where each mask covered by other masks
                 is reduced in its alpha value by this specified factor.
+            cfg_cache_interval (int): After the warmup, the unconditional
+                branch of the classifier-free guidance is evaluated only once
+                every this many steps. In the other steps, only the conditional
+                branch is evaluated and the unconditional prediction is
+                recovered from the cached difference between the two branches.
+                Set to 1 to disable.
+            cfg_cache_warmup (int): Number of initial steps where both of the
+                branches are always evaluated.
+            tea_cache_threshold (float): Threshold of the accumulated relative
+                L1 change of the input latent of each view, below which the
+                noise prediction of the previous step is reused instead of
+                running the U-Net. Set to 0 to disable.
 
         Returns: A PIL.Image image of a panorama (large-size) image.
         """
@@ -1119,10 +1504,15 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
         if has_background:
             if background is None and background_prompt is not None:
                 fg_masks = torch.cat((bg_masks[None], fg_masks), dim=0)
+                # Shared prompts are spelled out per mask, since the background prompt prepended below
+                # breaks the one-to-all broadcast of the embeddings.
+                prompts = prompts * num_masks if num_prompts == 1 else prompts
+                negative_prompts = negative_prompts * num_masks if num_nprompts == 1 else negative_prompts
                 if suffix is not None:
                     prompts = [p + suffix + background_prompt for p in prompts]
                 prompts = [background_prompt] + prompts
                 negative_prompts = [background_negative_prompt] + negative_prompts
+                num_masks = num_prompts = num_nprompts = fg_masks.shape[0]
                 has_background = False # Regard that background does not exist.
             else:
                 if background is None and background_prompt is None:
@@ -1136,7 +1526,12 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
                 negative_prompts = [background_negative_prompt] + negative_prompts
                 if isinstance(background, Image.Image):
                     background = T.ToTensor()(background).to(dtype=self.dtype, device=self.device)[None]
-                background = F.interpolate(background, size=(height, width), mode='bicubic', align_corners=False)
+                if background.shape[-2:] != (height, width):
+                    # Area averaging for downsampling, bilinear for upsampling.
+                    if background.shape[-2] >= height and background.shape[-1] >= width:
+                        background = F.interpolate(background, size=(height, width), mode='area')
+                    else:
+                        background = F.interpolate(background, size=(height, width), mode='bilinear', align_corners=False)
                 bg_latent = self.encode_imgs(background)
 
         # Bootstrapping stage preparation.
@@ -1176,28 +1571,53 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
         negative_pooled_prompt_embeds = None
         text_encoder_lora_scale = None
 
+        clip_skip = None
+
         prompt_embeds = None
         negative_prompt_embeds = None
 
-        (
-            prompt_embeds,
-            negative_prompt_embeds,
-            pooled_prompt_embeds,
-            negative_pooled_prompt_embeds,
-        ) = self.encode_prompt(
-            prompt=prompts,
-            prompt_2=prompt_2,
-            device=device,
-            num_images_per_prompt=num_images_per_prompt,
-            do_classifier_free_guidance=do_classifier_free_guidance,
-            negative_prompt=negative_prompts,
-            negative_prompt_2=negative_prompt_2,
-            prompt_embeds=prompt_embeds,
-            negative_prompt_embeds=negative_prompt_embeds,
-            pooled_prompt_embeds=pooled_prompt_embeds,
-            negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
-            lora_scale=text_encoder_lora_scale,
-        )
+        # Text encoders are skipped if the same set of prompts has been encoded recently. Cached embeddings
+        # are kept in the (pinned) host memory and copied back asynchronously.
+        prompt_cache_key = (tuple(prompts), tuple(negative_prompts), clip_skip, do_classifier_free_guidance)
+        if prompt_cache_key in self.prompt_cache:
+            self.prompt_cache.move_to_end(prompt_cache_key)
+            (
+                prompt_embeds,
+                negative_prompt_embeds,
+                pooled_prompt_embeds,
+                negative_pooled_prompt_embeds,
+            ) = (
+                e.to(device, non_blocking=True) if e is not None else None
+                for e in self.prompt_cache[prompt_cache_key]
+            )
+        else:
+            (
+                prompt_embeds,
+                negative_prompt_embeds,
+                pooled_prompt_embeds,
+                negative_pooled_prompt_embeds,
+            ) = self.encode_prompt(
+                prompt=prompts,
+                prompt_2=prompt_2,
+                device=device,
+                num_images_per_prompt=num_images_per_prompt,
+                do_classifier_free_guidance=do_classifier_free_guidance,
+                negative_prompt=negative_prompts,
+                negative_prompt_2=negative_prompt_2,
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_prompt_embeds,
+                pooled_prompt_embeds=pooled_prompt_embeds,
+                negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+                lora_scale=text_encoder_lora_scale,
+                clip_skip=clip_skip,
+            )
+            pin_memory = torch.device(device).type == 'cuda'
+            self.prompt_cache[prompt_cache_key] = tuple(
+                (e.cpu().pin_memory() if pin_memory else e.cpu()) if e is not None else None
+                for e in (prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds)
+            )
+            if len(self.prompt_cache) > self.prompt_cache_size:
+                self.prompt_cache.popitem(last=False)
 
         add_text_embeds = pooled_prompt_embeds
         if self.text_encoder_2 is None:
@@ -1238,26 +1658,37 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
 
             be = prompt_embeds[:1]
             fe = prompt_embeds[1:]
-            prompt_embeds = torch.lerp(be, fe, s)  # (p, 77, 1024)
+            prompt_embeds = torch.lerp(be, fe, s)  # (p, 77, 2048)
+            add_text_embeds = torch.lerp(add_text_embeds[:1], add_text_embeds[1:], s[..., 0])  # (p, 1280)
 
             if negative_prompt_embeds is not None:
                 bu = negative_prompt_embeds[:1]
                 fu = negative_prompt_embeds[1:]
+                bpu = negative_pooled_prompt_embeds[:1]
+                fpu = negative_pooled_prompt_embeds[1:]
                 if num_prompts > num_nprompts:
                     # # negative prompts = 1; # prompts > 1.
-                    assert fu.shape[0] == 1 and fe.shape == num_prompts
-                    fu = fu.repeat(num_prompts, 1, 1)
-                negative_prompt_embeds = torch.lerp(bu, fu, s)  # (n, 77, 1024)
+                    assert fu.shape[0] == 1 and fe.shape[0] == num_prompts
+                    fu = fu.expand(num_prompts, -1, -1)
+                    fpu = fpu.expand(num_prompts, -1)
+                negative_prompt_embeds = torch.lerp(bu, fu, s)  # (n, 77, 2048)
+                negative_pooled_prompt_embeds = torch.lerp(bpu, fpu, s[..., 0])  # (n, 1280)
         elif negative_prompt_embeds is not None and num_prompts > num_nprompts:
             # # negative prompts = 1; # prompts > 1.
             assert negative_prompt_embeds.shape[0] == 1 and prompt_embeds.shape[0] == num_prompts
-            negative_prompt_embeds = negative_prompt_embeds.repeat(num_prompts, 1, 1)
+            negative_prompt_embeds = negative_prompt_embeds.expand(num_prompts, -1, -1)
+            negative_pooled_prompt_embeds = negative_pooled_prompt_embeds.expand(num_prompts, -1)
         # assert negative_prompt_embeds.shape[0] == prompt_embeds.shape[0] == num_prompts
         if num_masks > num_prompts:
-            assert masks.shape[0] == num_masks and num_prompts == 1
-            prompt_embeds = prompt_embeds.repeat(num_masks, 1, 1)
+            # All regions are denoised in a single U-Net batch, so every conditioning tensor is
+            # broadcast to the number of masks. These are stride-0 views; the batch is materialized
+            # only once, when the views are batched right before the U-Net.
+            assert num_prompts == 1
+            prompt_embeds = prompt_embeds.expand(num_masks, -1, -1)
+            add_text_embeds = add_text_embeds.expand(num_masks, -1)
             if negative_prompt_embeds is not None:
-                negative_prompt_embeds = negative_prompt_embeds.repeat(num_masks, 1, 1)
+                negative_prompt_embeds = negative_prompt_embeds.expand(num_masks, -1, -1)
+                negative_pooled_prompt_embeds = negative_pooled_prompt_embeds.expand(num_masks, -1)
 
         # SDXL pipeline settings.
         if do_classifier_free_guidance:
@@ -1266,8 +1697,7 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
             add_time_ids = torch.cat([negative_add_time_ids, add_time_ids], dim=0)
         del negative_prompt_embeds, negative_pooled_prompt_embeds, negative_add_time_ids
 
-        prompt_embeds = prompt_embeds.to(device)
-        add_text_embeds = add_text_embeds.to(device)
+        # Text embeddings are already on the device; only the time ids are built on the host.
         add_time_ids = add_time_ids.to(device).repeat(batch_size * num_images_per_prompt, 1)
 
 
@@ -1275,99 +1705,217 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
 
         # Latent initialization.
         if self.timesteps[0] < 999 and has_background:
-            latents = self.scheduler_add_noise(bg_latents, None, 0, initial=True)
+            latents = self.scheduler_add_noise(bg_latent, None, 0, initial=True)
         else:
             latents = torch.randn((1, self.unet.config.in_channels, h, w), dtype=self.dtype, device=self.device)
-            latents = latents * self.scheduler.init_noise_sigma
+            latents.mul_(self.scheduler.init_noise_sigma)
 
         # Tiling (if needed).
         if height > tile_size or width > tile_size:
             t = (tile_size + self.vae_scale_factor - 1) // self.vae_scale_factor
             views, tile_masks = get_panorama_views(h, w, t)
-            tile_masks = tile_masks.to(self.device)
+            tile_masks = tile_masks.to(self.device, self.dtype)
         else:
             views = [(0, h, 0, w)]
             tile_masks = latents.new_ones((1, 1, h, w))
-        value = torch.zeros_like(latents)
-        count_all = torch.zeros_like(latents)
-
-        with torch.autocast('cuda'):
-            for i, t in enumerate(tqdm(self.timesteps)):
-                fg_mask = fg_masks[:, i]
-                bg_mask = bg_masks[i:i + 1]
 
+        # Accumulation buffers are kept across calls and reallocated only when the latent size changes.
+        # They are zeroed at every step.
+        if (
+            self.value_buffer is None
+            or self.value_buffer.shape != latents.shape
+            or self.value_buffer.dtype != latents.dtype
+        ):
+            self.value_buffer = torch.empty_like(latents)
+            self.count_buffer = torch.empty_like(latents)
+        value = self.value_buffer
+        count_all = self.count_buffer
+
+        # CFG cache: the difference between the conditional and the unconditional predictions of each view.
+        cfg_cache = {}
+        # TeaCache: the last input latent, the noise prediction, and the accumulated change of each view.
+        tea_cache = {}
+        # Text embeddings repeated for the batched views, keyed by (use_cfg_cache, number of views).
+        batched_embeds = {}
+
+        single_view = len(views) == 1
+
+        # The slices of each view, and the views of the tile masks and the accumulation buffers, are made once.
+        view_slices = [(..., slice(h_start, h_end), slice(w_start, w_end)) for h_start, h_end, w_start, w_end in views]
+        view_tile_masks = [tile_masks[:, j:j + 1][sl] for j, sl in enumerate(view_slices)]
+        view_values = [value[sl] for sl in view_slices]
+        view_counts = [count_all[sl] for sl in view_slices]
+
+        for i, t in enumerate(tqdm(self.timesteps) if self.verbose else self.timesteps):
+            # Made contiguous once per step so that the masks of all the views are read from dense rows.
+            fg_mask = fg_masks[:, i].contiguous()
+            bg_mask = bg_masks[i:i + 1]
+
+            if not single_view:
                 value.zero_()
                 count_all.zero_()
-                for j, (h_start, h_end, w_start, w_end) in enumerate(views):
-                    fg_mask_ = fg_mask[..., h_start:h_end, w_start:w_end]
-                    latents_ = latents[..., h_start:h_end, w_start:w_end].repeat(num_masks, 1, 1, 1)
-
-                    # Additional arguments for the SDXL pipeline.
-                    add_time_ids_input = add_time_ids.clone()
-                    add_time_ids_input[:, 2] = h_start * self.vae_scale_factor
-                    add_time_ids_input[:, 3] = w_start * self.vae_scale_factor
-                    add_time_ids_input = add_time_ids_input.repeat_interleave(num_prompts, dim=0)
-
-                    # Bootstrap for tight background.
-                    if i < bootstrap_steps:
-                        mix_ratio = min(1, max(0, boostrap_mix_steps - i))
-                        # Treat the first foreground latent as the background latent if one does not exist.
-                        bg_latents_ = bg_latents[..., h_start:h_end, w_start:w_end] if has_background else latents_[:1]
-                        white_ = white[..., h_start:h_end, w_start:w_end]
-                        white_ = self.scheduler_add_noise(white_, None, i, initial=True)
-                        bg_latents_ = mix_ratio * white_ + (1.0 - mix_ratio) * bg_latents_
-                        latents_ = (1.0 - fg_mask_) * bg_latents_ + fg_mask_ * latents_
-
-                        # Centering.
-                        latents_ = shift_to_mask_bbox_center(latents_, fg_mask_, reverse=True)
-
-                    latent_model_input = torch.cat([latents_] * 2) if do_classifier_free_guidance else latents_
-                    latent_model_input = self.scheduler_scale_model_input(latent_model_input, i)
-
-                    # Perform one step of the reverse diffusion.
-                    added_cond_kwargs = {"text_embeds": add_text_embeds, "time_ids": add_time_ids_input}
-                    noise_pred = self.unet(
-                        latent_model_input,
-                        t,
-                        encoder_hidden_states=prompt_embeds,
-                        timestep_cond=None,
-                        cross_attention_kwargs=None,
-                        added_cond_kwargs=added_cond_kwargs,
-                        return_dict=False,
-                    )[0]
-
-                    if do_classifier_free_guidance:
-                        noise_pred_uncond, noise_pred_cond = noise_pred.chunk(2)
-                        noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_cond - noise_pred_uncond)
-
-                    if do_classifier_free_guidance and guidance_rescale > 0.0:
-                        # Based on 3.4. in https://arxiv.org/pdf/2305.08891.pdf
-                        noise_pred = rescale_noise_cfg(noise_pred, noise_pred_cond, guidance_rescale=guidance_rescale)
-
-                    latents_ = self.scheduler_step(noise_pred, i, latents_)
+            white_noisy = None
+
+            # 1. Prepare the U-Net inputs of each view.
+            view_latents = []
+            view_fg_masks = []
+            view_bg_latents = []
+            view_time_ids = []
+            noise_preds = [None] * len(views)
+            # Views with the same latent shape and guidance mode are denoised in a single U-Net call.
+            batches = {}
+            for j, (h_start, h_end, w_start, w_end) in enumerate(views):
+                sl = view_slices[j]
+                fg_mask_ = fg_mask[sl]
+                latents_ = latents[sl].repeat(fg_masks.shape[0], 1, 1, 1)
+
+                # Additional arguments for the SDXL pipeline.
+                add_time_ids_input = add_time_ids.clone()
+                add_time_ids_input[:, 2] = h_start * self.vae_scale_factor
+                add_time_ids_input[:, 3] = w_start * self.vae_scale_factor
+                add_time_ids_input = add_time_ids_input.repeat_interleave(latents_.shape[0], dim=0)
+
+                # Bootstrap for tight background.
+                bg_latents_ = None
+                if i < bootstrap_steps:
+                    mix_ratio = min(1, max(0, boostrap_mix_steps - i))
+                    # Treat the first foreground latent as the background latent if one does not exist.
+                    bg_latents_ = bg_latent[sl] if has_background else latents_[:1]
+                    # The noisy white latent is made once per step, at the first view that needs it.
+                    if white_noisy is None:
+                        white_noisy = self.scheduler_add_noise(white, None, i, initial=True)
+                    white_ = white_noisy[sl]
+                    latents_, bg_latents_ = self.bootstrap_mix(latents_, bg_latents_, white_, fg_mask_, mix_ratio)
+
+                    # Centering.
+                    latents_ = shift_to_mask_bbox_center(latents_, fg_mask_, reverse=True)
+
+                view_latents.append(latents_)
+                view_fg_masks.append(fg_mask_)
+                view_bg_latents.append(bg_latents_)
+                view_time_ids.append(add_time_ids_input)
+
+                # TeaCache: reuse the previous prediction of this view while the accumulated relative
+                # change of its input stays below the threshold. The first and the last steps always run.
+                reuse_noise_pred = False
+                if tea_cache_threshold > 0 and 0 < i < len(self.timesteps) - 1 and j in tea_cache:
+                    prev_latents_, prev_noise_pred, acc_rel_l1 = tea_cache[j]
+                    rel_l1 = (latents_ - prev_latents_).abs().mean() / prev_latents_.abs().mean()
+                    acc_rel_l1 += rel_l1.item()
+                    reuse_noise_pred = acc_rel_l1 < tea_cache_threshold
+
+                if reuse_noise_pred:
+                    noise_preds[j] = prev_noise_pred
+                    tea_cache[j] = (latents_, prev_noise_pred, acc_rel_l1)
+                else:
+                    use_cfg_cache = (
+                        j in cfg_cache
+                        and i >= cfg_cache_warmup
+                        and (i - cfg_cache_warmup) % cfg_cache_interval != 0
+                    )
+                    batches.setdefault((use_cfg_cache, tuple(latents_.shape)), []).append(j)
+
+            # 2. Perform one step of the reverse diffusion for each batch of views.
+            for (use_cfg_cache, _), js in batches.items():
+                num_views = len(js)
+                latents_batch = torch.cat([view_latents[j] for j in js], dim=0)
+
+                if (use_cfg_cache, num_views) not in batched_embeds:
+                    if use_cfg_cache:
+                        # Conditional branch only, with the half batch.
+                        embeds = (
+                            prompt_embeds.chunk(2)[1].repeat(num_views, 1, 1),
+                            add_text_embeds.chunk(2)[1].repeat(num_views, 1),
+                        )
+                    elif do_classifier_free_guidance:
+                        # Unconditional halves of all views first, then the conditional halves.
+                        embeds = (
+                            torch.cat([e.repeat(num_views, 1, 1) for e in prompt_embeds.chunk(2)], dim=0),
+                            torch.cat([e.repeat(num_views, 1) for e in add_text_embeds.chunk(2)], dim=0),
+                        )
+                    else:
+                        embeds = (prompt_embeds.repeat(num_views, 1, 1), add_text_embeds.repeat(num_views, 1))
+                    batched_embeds[(use_cfg_cache, num_views)] = embeds
+                prompt_embeds_input, add_text_embeds_input = batched_embeds[(use_cfg_cache, num_views)]
+
+                if use_cfg_cache:
+                    latent_model_input = latents_batch
+                    add_time_ids_batch = torch.cat([view_time_ids[j].chunk(2)[1] for j in js], dim=0)
+                elif do_classifier_free_guidance:
+                    latent_model_input = torch.cat([latents_batch] * 2)
+                    add_time_ids_batch = torch.cat(
+                        [view_time_ids[j].chunk(2)[0] for j in js] + [view_time_ids[j].chunk(2)[1] for j in js],
+                        dim=0,
+                    )
+                else:
+                    latent_model_input = latents_batch
+                    add_time_ids_batch = torch.cat([view_time_ids[j] for j in js], dim=0)
+                latent_model_input = self.scheduler_scale_model_input(latent_model_input, i)
 
-                    if i < bootstrap_steps:
-                        # Uncentering.
-                        latents_ = shift_to_mask_bbox_center(latents_, fg_mask_)
+                added_cond_kwargs = {"text_embeds": add_text_embeds_input, "time_ids": add_time_ids_batch}
+                noise_pred = self.unet_forward(latent_model_input, t, prompt_embeds_input, added_cond_kwargs)
 
-                        # Remove leakage (optional).
-                        leak = (latents_ - bg_latents_).pow(2).mean(dim=1, keepdim=True)
-                        leak_sigmoid = torch.sigmoid(leak / bootstrap_leak_sensitivity) * 2 - 1
-                        fg_mask_ = fg_mask_ * leak_sigmoid
+                if do_classifier_free_guidance and not use_cfg_cache:
+                    noise_pred_uncond, noise_pred_cond = noise_pred.chunk(2)
+                    noise_pred_uncond = noise_pred_uncond.chunk(num_views)
+                else:
+                    noise_pred_cond = noise_pred
+                noise_pred_cond = noise_pred_cond.chunk(num_views)
+
+                for k, j in enumerate(js):
+                    noise_pred_cond_ = noise_pred_cond[k]
+                    if not do_classifier_free_guidance:
+                        noise_pred_ = noise_pred_cond_
+                    elif use_cfg_cache:
+                        noise_pred_ = noise_pred_cond_ + (guidance_scale - 1) * cfg_cache[j]
+                    else:
+                        noise_pred_delta = noise_pred_cond_ - noise_pred_uncond[k]
+                        if cfg_cache_interval > 1:
+                            cfg_cache[j] = noise_pred_delta
+                        noise_pred_ = noise_pred_uncond[k] + guidance_scale * noise_pred_delta
 
-                    # Mix the latents.
-                    fg_mask_ = fg_mask_ * tile_masks[:, j:j + 1, h_start:h_end, w_start:w_end]
-                    value[..., h_start:h_end, w_start:w_end] += (fg_mask_ * latents_).sum(dim=0, keepdim=True)
-                    count_all[..., h_start:h_end, w_start:w_end] += fg_mask_.sum(dim=0, keepdim=True)
+                    if do_classifier_free_guidance and guidance_rescale > 0.0:
+                        # Based on 3.4. in https://arxiv.org/pdf/2305.08891.pdf
+                        noise_pred_ = rescale_noise_cfg(noise_pred_, noise_pred_cond_, guidance_rescale=guidance_rescale)
+
+                    if tea_cache_threshold > 0:
+                        tea_cache[j] = (view_latents[j], noise_pred_, 0.0)
+                    noise_preds[j] = noise_pred_
+
+            # 3. Denoise each view and mix the latents.
+            for j in range(len(views)):
+                latents_ = self.scheduler_step(noise_preds[j], i, view_latents[j])
+                fg_mask_ = view_fg_masks[j]
+
+                if i < bootstrap_steps:
+                    # Uncentering.
+                    latents_ = shift_to_mask_bbox_center(latents_, fg_mask_)
+
+                    # Remove leakage (optional).
+                    leak = (latents_ - view_bg_latents[j]).pow(2).mean(dim=1, keepdim=True)
+                    leak_sigmoid = torch.sigmoid(leak / bootstrap_leak_sensitivity) * 2 - 1
+                    fg_mask_ = fg_mask_ * leak_sigmoid
+
+                # Mix the latents. A single view covers the whole latent with a unit tile mask, so the
+                # masked sums are the final values and nothing has to be accumulated.
+                if single_view:
+                    value = (fg_mask_ * latents_).sum(dim=0, keepdim=True)
+                    count_all = fg_mask_.sum(dim=0, keepdim=True)
+                else:
+                    self.mix_tile(latents_, fg_mask_, view_tile_masks[j], view_values[j], view_counts[j])
 
-                latents = torch.where(count_all > 0, value / count_all, value)
-                bg_mask = (1 - count_all).clip_(0, 1)  # (T, 1, h, w)
-                if has_background:
-                    latents = (1 - bg_mask) * latents + bg_mask * bg_latents
+            bg_mask = (1 - count_all).clip_(0, 1)  # (T, 1, h, w)
+            # `value` is zero wherever `count_all` is, so the clamp only affects the zero counts. The reciprocal
+            # is taken in fp32, whose smallest normal number (1.2e-38) is below every nonzero fp16 count and
+            # all but subnormal bf16 counts.
+            inv_count = count_all.float().clamp_min_(torch.finfo(torch.float32).tiny).reciprocal_()
+            latents = (value * inv_count).to(value.dtype)
+            if has_background:
+                latents = (1 - bg_mask) * latents + bg_mask * bg_latent
 
-                # Noise is added after mixing.
-                if i < len(self.timesteps) - 1:
-                    latents = self.scheduler_add_noise(latents, None, i + 1)
+            # Noise is added after mixing.
+            if i < len(self.timesteps) - 1:
+                latents = self.scheduler_add_noise(latents, None, i + 1)
 
         if not output_type == "latent":
             # make sure the VAE is in float32 mode, as it overflows in float16
@@ -1392,7 +1940,19 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
             else:
                 latents = latents / self.vae.config.scaling_factor
 
-            image = self.vae.decode(latents, return_dict=False)[0]
+            # Tiled decoding with the same tile size as the denoising views bounds the peak memory of panoramas.
+            # The encoder shares these settings, so they are restored right after the decode.
+            tiling_keys = ('tile_sample_min_size', 'tile_latent_min_size', 'tile_overlap_factor')
+            tiling_saved = {k: getattr(self.vae, k) for k in tiling_keys if hasattr(self.vae, k)}
+            if len(tiling_saved) == len(tiling_keys):
+                self.vae.tile_sample_min_size = tile_size
+                self.vae.tile_latent_min_size = tile_size // self.vae_scale_factor
+                self.vae.tile_overlap_factor = 0.25
+            try:
+                image = self.vae.decode(latents.contiguous(memory_format=torch.channels_last), return_dict=False)[0]
+            finally:
+                for k, v in tiling_saved.items():
+                    setattr(self.vae, k, v)
 
             # cast back to fp16 if needed
             if needs_upcasting:
@@ -1401,7 +1961,7 @@ class StableMultiDiffusionSDXLPipeline(nn.Module):
             image = latents
 
         # Return PIL Image.
-        image = image[0].clip_(-1, 1) * 0.5 + 0.5
+        image = image[0].clip_(-1, 1).mul_(0.5).add_(0.5)
         if has_background and do_blend:
             fg_mask = torch.sum(masks_g, dim=0).clip_(0, 1)
             image = blend(image, background[0], fg_mask)